@@ -1,49 +1,254 @@
 import poplib
 import email
+import email.message
+import email.parser
+import queue
+import threading
+import time
 from email.header import decode_header, make_header
 import logging
-from typing import Iterable, Callable
+from typing import Iterable, Iterator, Callable
+from collections.abc import MutableMapping
+from concurrent.futures import Executor
 import functools
+import contextlib
 
-__all__ = ["parse_email", "POP3Client", "MAIL_HEADER_NAMES"]
+__all__ = ["parse_email", "parse_headers", "POP3Client", "MAIL_HEADER_NAMES", "DEFAULT_PIPELINE_DEPTH", "POOL_IDLE_TIMEOUT",
+           "POOL_MAX_AGE", "MAX_HEADER_LENGTH", "MAX_HEADER_SEPARATORS"]
 
-MAIL_HEADER_NAMES = ["From", "To", "Subject", "Date", "Message-Id", "In-Reply-To",
+MAIL_HEADER_NAMES = ("From", "To", "Subject", "Date", "Message-Id", "In-Reply-To",
                      "References", "Reply-To", "Received", "Mime-Version",
-                     "Content-Type", "Content-Transfer-Encoding", "Content-Disposition"]
+                     "Content-Type", "Content-Transfer-Encoding", "Content-Disposition")
 
+# {小文字のヘッダ名: MAIL_HEADER_NAMES のヘッダ名}
+_HEADER_NAMES_LOWER = {header_name.lower(): header_name for header_name in MAIL_HEADER_NAMES}
 
-def parse_email(msg: bytes) -> dict:
+# utf-8 コーデックでそのままデコードできる charset
+_UTF8_CHARSETS = frozenset({"us-ascii", "ascii", "utf-8", "utf8"})
+
+# デコードせずにそのまま戻すヘッダの長さと ';' の数の上限
+# email.header のデコードに極端に時間がかかるヘッダ (bpo-42909) への対策
+MAX_HEADER_LENGTH = 4096
+MAX_HEADER_SEPARATORS = 64
+
+# サーバが PIPELINING に対応しているとき、応答を待たずに送信するコマンド数の既定値
+DEFAULT_PIPELINE_DEPTH = 32
+# 応答を待たずに送信するコマンド数の初期値。応答を受け取るごとに pipeline_depth まで増やす
+_INITIAL_PIPELINE_WINDOW = 8
+
+# プールに戻した接続を再利用せずに閉じるまでの秒数
+# RFC 1939 のサーバ側 autologout タイマー (10分以上) より十分短くする
+POOL_IDLE_TIMEOUT = 60
+# 接続してからこの秒数を過ぎた接続はプールに戻さずにサインアウトする
+# POP3 のセッションはログイン後に届いたメッセージを返さないため、新着メッセージが見えない期間の上限となる
+POOL_MAX_AGE = 300
+
+# 認証済みの POP3 接続のプール {(POP3クラス, host, port, user, password, auth_method, option): LifoQueue}
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+_logger = logging.getLogger(__name__)
+
+# パーサは状態を持たないため、メッセージごとに作らず使い回す
+_PARSER = email.parser.BytesParser()
+_HEADER_PARSER = email.parser.BytesHeaderParser()
+
+
+def _decode_header(name: str, header, logger: logging.Logger) -> str:
+    """
+    ヘッダをデコードした結果を戻す
+    MAX_HEADER_LENGTH または MAX_HEADER_SEPARATORS を超えるヘッダはデコードせずにそのまま戻す
+    ---
+    Parameters:
+        name: ヘッダ名
+        header: ヘッダの内容
+        logger: デコードを省略したときに警告を記録するLogger
+    """
+    raw = str(header)
+    separators = raw.count(';')
+    if len(raw) > MAX_HEADER_LENGTH or separators > MAX_HEADER_SEPARATORS:
+        logger.warning("%s header not decoded (length=%d, separators=%d)", name, len(raw), separators)
+        return raw
+    return str(make_header(decode_header(header)))
+
+
+class _LazyHeaders(MutableMapping):
+    """
+    ヘッダの値を最初に参照されたときにデコードし、結果を保持する辞書
+    ---
+    Parameters:
+        raw_headers: {ヘッダ名: デコード前の内容, ...}
+        logger: デコードを省略したときに警告を記録するLogger
+    """
+    def __init__(self, raw_headers: dict, logger: logging.Logger):
+        self._items = dict(raw_headers)
+        self._pending = set(raw_headers)
+        self._logger = logger
+
+    def __getitem__(self, key):
+        value = self._items[key]
+        if key in self._pending:
+            value = self._items[key] = _decode_header(key, value, self._logger)
+            self._pending.discard(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._pending.discard(key)
+
+    def __delitem__(self, key):
+        del self._items[key]
+        self._pending.discard(key)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        return self[key] if key in self._items else default
+
+    def copy(self):
+        headers = _LazyHeaders({}, self._logger)
+        headers._items = self._items.copy()
+        headers._pending = self._pending.copy()
+        return headers
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __getstate__(self):
+        # 別プロセスに渡すときは、受け取った側でデコードしないようにデコードを済ませておく
+        return {'_items': dict(self), '_pending': set(), '_logger': None}
+
+
+def _decode_payload(payload: bytes, charset: str) -> (str, str):
+    """
+    本文を charset でデコードした結果を戻す
+    ASCII と UTF-8 は utf-8 コーデックで直接デコードし、未知の charset や
+    'replace' でもデコードできない charset (idna, punycode など) は UTF-8 とみなす
+    デコードできないバイトは U+FFFD に置き換える
+    ---
+    Parameters:
+        payload: 本文
+        charset: 本文パートの charset
+    ---
+    Returns:
+        デコードした本文, デコードに使用した charset
+    """
+    if charset not in _UTF8_CHARSETS:
+        try:
+            return payload.decode(charset, "replace"), charset
+        except (LookupError, UnicodeError):
+            charset = "utf-8"
+    return payload.decode("utf-8", "replace"), charset
+
+
+def _get_raw_headers(msg: email.message.Message) -> dict:
+    """
+    MAIL_HEADER_NAMES のヘッダをデコードせずに取り出す
+    ---
+    Parameters:
+        msg: email.message.Message またはそのパート
+    ---
+    Returns:
+        {ヘッダ名: 内容, ...}
+    """
+    found = {}
+    for name, value in msg.raw_items():
+        header_name = _HEADER_NAMES_LOWER.get(name.lower())
+        if header_name:
+            found.setdefault(header_name, value)
+    headers = {}
+    for header_name in MAIL_HEADER_NAMES:
+        header = found.get(header_name)
+        if header:
+            headers[header_name] = msg.policy.header_fetch_parse(header_name, header)
+    return headers
+
+
+def _get_body_data(part: email.message.Message, raw_headers: dict = None) -> dict:
+    """
+    本文パートのヘッダと本文を戻す
+    ---
+    Parameters:
+        part: 本文パート
+        raw_headers: 取得済みの本文パートのヘッダ。None のときは part から取り出す
+    ---
+    Returns:
+        {本文パートヘッダ名: 内容, ... , "data": 本文}。本文がないときは None
+    """
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return None
+    body_data = dict(raw_headers) if raw_headers is not None else _get_raw_headers(part)
+    charset = part.get_content_charset()
+    if charset is None and part.get_content_maintype() == "text":
+        charset = "utf-8"
+    if charset:
+        payload, charset = _decode_payload(payload, charset)
+        body_data["charset"] = charset
+    body_data["data"] = payload
+    return body_data
+
+
+def _decode_headers(raw_headers: dict, logger: logging.Logger, lazy: bool) -> MutableMapping:
+    """
+    デコード前のヘッダをデコードした辞書を戻す
+    ---
+    Parameters:
+        raw_headers: {ヘッダ名: デコード前の内容, ...}
+        logger: デコードを省略したときに警告を記録するLogger
+        lazy: True のときは最初に参照されたときにデコードする _LazyHeaders を戻す
+    """
+    if lazy:
+        return _LazyHeaders(raw_headers, logger)
+    return {name: _decode_header(name, value, logger) for name, value in raw_headers.items()}
+
+
+def parse_headers(msg: bytes, logger: logging.Logger = None, lazy: bool = False) -> dict:
+    """
+    email のヘッダのみをパースした結果を戻す
+    本文の構造の解析とデコードを行わないため、parse_email より高速
+    ---
+    Parameters:
+        msg: email またはそのヘッダ部分
+        logger: ヘッダのデコードを省略したときに警告を記録するLogger
+        lazy: parse_email と同様
+    ---
+    Returns:
+        {ヘッダ名: 内容, ...}
+    """
+    msg = _HEADER_PARSER.parsebytes(msg)
+    return _decode_headers(_get_raw_headers(msg), logger if logger else _logger, lazy)
+
+
+def parse_email(msg: bytes, logger: logging.Logger = None, lazy: bool = False) -> dict:
     """
     email をパースした結果を戻す
     ---
     Parameters:
         msg: email
+        logger: ヘッダのデコードを省略したときに警告を記録するLogger
+        lazy: True のときはトップレベルのヘッダの値を最初に参照されたときにデコードする MutableMapping を戻す
     ---
     Returns:
         {ヘッダ名: 内容, ... ,"Body": [{本文パートヘッダ名: 内容, ... , "data": 本文}, ...]}
     """
-    msg_data = {}
-    msg = email.message_from_bytes(msg)
-    for header_name in MAIL_HEADER_NAMES:
-        header = msg[header_name]
-        if header:
-            msg_data[header_name] = str(make_header(decode_header(header)))
-
-    body_parts = []
-
-    for part in msg.walk():
-        payload = part.get_payload(decode=True)
-        if payload:
-            body_data = {}
-            for header_name in MAIL_HEADER_NAMES:
-                header = part.get(header_name)
-                if header:
-                    body_data[header_name] = part.get(header_name)
-            charset = part.get_content_charset()
-            if charset:
-                payload = payload.decode(charset, "ignore")
-            body_data["data"] = payload
-            body_parts.append(body_data)
+    msg = _PARSER.parsebytes(msg)
+    raw_headers = _get_raw_headers(msg)
+    msg_data = _decode_headers(raw_headers, logger if logger else _logger, lazy)
+
+    if msg.is_multipart():
+        body_parts = [body_data for part in msg.walk() if (body_data := _get_body_data(part))]
+    else:
+        # シングルパートのときは walk せず、取得済みのヘッダをそのまま本文パートのヘッダとして使う
+        body_data = _get_body_data(msg, raw_headers)
+        body_parts = [body_data] if body_data else []
 
     msg_data["Body"] = body_parts
 
@@ -65,10 +270,21 @@ class POP3Client:
         auth_method: 認証にAPOPまたはRPOPを使用するとき、"apop" または "rpop" を指定する)
         option: poplib.POP3 または poplib.POP3_SSL コンストラクタに渡す host, port 以外の引数の辞書
         logger: pop3通信を行ったときのサーバからのメッセージをログとして記録するLogger
+        pipeline_depth: 応答を待たずに送信する RETR コマンドの最大数 (1 以上)
+                        None のときはサーバが PIPELINING に対応していれば DEFAULT_PIPELINE_DEPTH、そうでなければ 1
+        use_pool: True のとき quit で接続を閉じずにプールに戻し、次回の connect で再利用する
+        max_messages_per_conn: use_pool のとき、この件数のメッセージを取得した接続はプールに戻さずに閉じる
+        parse_executor: 取得したメッセージのパースを実行する Executor (ProcessPoolExecutor など)
+                        None のときは取得と同じスレッドでパースする
+        lazy_headers: True のとき取得したメッセージのヘッダを最初に参照されたときにデコードする
     """
     def __init__(self, user: str, password: str, host: str,
                  port: int = None, old_uid: Iterable = None, use_ssl: bool = True,
-                 auth_method: str = None, option: dict = {}, logger: logging.Logger = None):
+                 auth_method: str = None, option: dict = {}, logger: logging.Logger = None,
+                 pipeline_depth: int = None, use_pool: bool = False, max_messages_per_conn: int = 100,
+                 parse_executor: Executor = None, lazy_headers: bool = False):
+        if pipeline_depth is not None and pipeline_depth < 1:
+            raise ValueError(f"pipeline_depth must be 1 or greater: {pipeline_depth}")
         self.host = host
         if use_ssl:
             self.port = port if port else poplib.POP3_SSL_PORT
@@ -82,25 +298,34 @@ class POP3Client:
         self.pop3 = None
         self.auth_method = auth_method
         self.option = option
-        self.logger = logger if logger else self._get_default_logger()
+        self.logger = logger if logger else _get_default_logger(self.host, self.user)
+        self.pipeline_depth = pipeline_depth
+        self.use_pool = use_pool
+        self.max_messages_per_conn = max_messages_per_conn
+        self.parse_executor = parse_executor
+        self.lazy_headers = lazy_headers
 
     def __del__(self):
-        try:
-            self.quit()
-        except Exception:
-            pass
+        if getattr(self, 'pop3', None) is not None:
+            self._close(reuse=False, silent=True)
 
     def __enter__(self):
         self.connect()
         return self
 
     def __exit__(self, ex_type, ex_value, trace):
-        self.quit()
+        self.quit(reuse=ex_type is None)
 
     def connect(self):
         """
         POP3オブジェクトを作成し、認証を行う
+        use_pool のときはプールに認証済みの接続があればそれを使う
         """
+        key = self._pool_key() if self.use_pool else None
+        if key:
+            self.pop3 = _pool_get(key, self.logger)
+            if self.pop3:
+                return
         self.pop3 = self.pop3_cls(self.host, self.port, logger=self.logger, **self.option)
         try:
             if self.auth_method == "apop":
@@ -112,15 +337,44 @@ class POP3Client:
                 self.pop3.user(self.user)
                 self.pop3.pass_(self.password)
         except Exception:
-            self.quit()
+            self._close(reuse=False, silent=True)
             raise
 
-    def quit(self):
+    def quit(self, reuse: bool = True):
         """
         POP3接続を閉じ、変更をコミットし、サーバの受信ボックスのロックを解除する
+        use_pool のときは接続を閉じずにプールに戻す
+        ---
+        QUIT が失敗したときは変更がコミットされていないため、接続を閉じたうえで例外を送出する
+        ---
+        Parameters:
+            reuse: False のときは use_pool であってもプールに戻さずに接続を閉じる
+        """
+        self._close(reuse, silent=False)
+
+    def _close(self, reuse: bool, silent: bool):
+        """
+        quit の本体
+        ---
+        Parameters:
+            reuse: quit と同様
+            silent: True のときは QUIT が失敗しても例外を送出しない (__del__ や認証失敗時のため)
         """
-        self.pop3.quit()
+        pop3 = self.pop3
+        if pop3 is None:
+            return
         self.pop3 = None
+        key = self._pool_key() if reuse and self.use_pool else None
+        if key and pop3.retr_count < self.max_messages_per_conn:
+            _pool_put(key, pop3)
+            return
+        try:
+            pop3.quit()
+        except (poplib.error_proto, OSError):
+            with contextlib.suppress(OSError):
+                pop3.close()
+            if not silent:
+                raise
 
     def get_all_unique_id(self) -> dict:
         """
@@ -129,8 +383,7 @@ class POP3Client:
         Returns:
             {unique_id: message_number, ...}
         """
-        all_uid = map(self._parse_unique_id, self.pop3.uidl()[1])
-        return {x[0]: x[1] for x in all_uid}
+        return dict(map(self._parse_unique_id, self.pop3.uidl()[1]))
 
     def get_new_unique_id(self) -> dict:
         """
@@ -152,12 +405,38 @@ class POP3Client:
         Returns:
             {unique_id: {ヘッダ名: 内容, ... ,"Body": [{本文パートヘッダ名: 内容, ... , "data": 本文}, ...]}, ...}
         """
-        msg_dict = {}
-        for uid, msg_no in uid_dict.items():
-            msg_dict[uid] = self._parse_message(self.pop3.retr(msg_no))
+        # 途中で例外が発生しても、送信済みコマンドの応答をその場で読み捨てるよう必ず close する
+        with contextlib.closing(
+                self._longcmd_pipelined([f'RETR {msg_no}' for msg_no in uid_dict.values()])) as results:
+            retr_results = zip(uid_dict.keys(), results)
+            if self.parse_executor:
+                futures = {uid: self.parse_executor.submit(_parse_message, retr_result, self.logger, self.lazy_headers)
+                           for uid, retr_result in retr_results}
+            else:
+                msg_dict = {uid: _parse_message(retr_result, self.logger, self.lazy_headers)
+                            for uid, retr_result in retr_results}
+        if self.parse_executor:
+            msg_dict = {uid: future.result() for uid, future in futures.items()}
+        self.pop3.retr_count += len(msg_dict)
         self.old_uid |= msg_dict.keys()
         return msg_dict
 
+    def get_headers_only(self, uid_dict: dict) -> dict:
+        """
+        uid_dict で指定されたメッセージのヘッダのみを取得する
+        TOP コマンドを使うため本文は転送されない
+        ---
+        Parameters:
+            uid_dict: {unique_id: message_number, ...}
+        ---
+        Returns:
+            {unique_id: {ヘッダ名: 内容, ...}, ...}
+        """
+        with contextlib.closing(
+                self._longcmd_pipelined([f'TOP {msg_no} 0' for msg_no in uid_dict.values()])) as top_results:
+            return {uid: parse_headers(top_result[1], self.logger, self.lazy_headers)
+                    for uid, top_result in zip(uid_dict.keys(), top_results)}
+
     def get_all_messages(self) -> dict:
         """
         サーバにあるすべてのメッセージを取得する
@@ -190,107 +469,307 @@ class POP3Client:
         """
         self.pop3.rset()
 
-    def _parse_unique_id(self, uid_bytes: bytes) -> (str, int):
+    def _pool_key(self) -> tuple:
         """
-        POP3.uidl の2番目の戻り値の要素をパースした結果を戻す
+        プールのキーを戻す
+        option にハッシュできない値が含まれるときは None を戻し、プールを使わない
+        """
+        key = (self.pop3_cls, self.host, self.port, self.user, self.password,
+               self.auth_method, tuple(sorted(self.option.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _get_pipeline_depth(self) -> int:
+        """
+        応答を待たずに送信するコマンドの最大数を戻す
+        pipeline_depth が指定されていないときは CAPA でサーバの PIPELINING 対応を確認する
+        """
+        if self.pipeline_depth is not None:
+            return self.pipeline_depth
+        if self.pop3.pipelining is None:
+            try:
+                self.pop3.pipelining = 'PIPELINING' in self.pop3.capa()
+            except poplib.error_proto:
+                self.pop3.pipelining = False
+        return DEFAULT_PIPELINE_DEPTH if self.pop3.pipelining else 1
+
+    def _longcmd_pipelined(self, commands: list) -> Iterator[tuple]:
+        """
+        複数行の応答を返すコマンドを、応答を待たずにまとめて送信し、応答を送信順に戻す
+        まとめて送信する数は _INITIAL_PIPELINE_WINDOW から始め、応答を受け取るごとに pipeline_depth まで増やす
+        いずれかのコマンドがエラーになったときは、送信済みコマンドの応答を読み切ってから例外を送出する
         ---
         Parameters:
-            uid_bytes: POP3.uidl の2番目の戻り値の要素
+            commands: 送信するコマンドのリスト
         ---
         Returns:
-            unique_id, message_number
+            (response, message, octets) を順に返すイテレータ
+            POP3.retr の戻り値と異なり、message は行のリストではなく CRLF で連結した bytearray
         """
-        msg_no, uid = uid_bytes.decode().split(' ')
-        msg_no = int(msg_no)
-        return uid, msg_no
+        depth = self._get_pipeline_depth()
+        window = min(_INITIAL_PIPELINE_WINDOW, depth)
+        count = len(commands)
+        sent = received = 0
+        error = None
+        try:
+            while received < count:
+                while sent < count and sent - received < window:
+                    self.pop3._putcmd(commands[sent])
+                    sent += 1
+                try:
+                    result = self._getlongresp_joined()
+                except poplib.error_proto as e:
+                    self.logger.error(_get_error_message(e))
+                    error = e
+                    count = sent
+                    continue
+                finally:
+                    received += 1
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info("%s -> %s", commands[received - 1], result[0].decode())
+                if error is None:
+                    window = min(window + 1, depth)
+                    yield result
+            if error is not None:
+                raise error
+        finally:
+            # 途中で中断されたときも、コネクションの同期を保つため送信済みコマンドの応答を読み捨てる
+            while received < sent:
+                received += 1
+                try:
+                    self._getlongresp_joined()
+                except (poplib.error_proto, OSError):
+                    pass
+
+    def _getlongresp_joined(self) -> tuple:
+        """
+        POP3._getlongresp と同様に複数行の応答を読み込む
+        行のリストを作らず、各行を CRLF で連結した bytearray に直接書き込む
+        ---
+        Returns:
+            response, message, octets
+        """
+        resp = self.pop3._getresp()
+        buf = bytearray()
+        octets = 0
+        line, o = self.pop3._getline()
+        while line != b'.':
+            if line.startswith(b'..'):
+                o = o - 1
+                line = line[1:]
+            octets = octets + o
+            buf += line
+            buf += b'\r\n'
+            line, o = self.pop3._getline()
+        del buf[-2:]
+        return resp, buf, octets
 
-    def _parse_message(self, retr_result: tuple) -> dict:
+    def _parse_unique_id(self, uid_bytes: bytes) -> (str, int):
         """
-        POP3.retr の戻り値をパースした結果を戻す
+        POP3.uidl の2番目の戻り値の要素をパースした結果を戻す
         ---
         Parameters:
-            retr_result: POP3.retr の戻り値
+            uid_bytes: POP3.uidl の2番目の戻り値の要素
         ---
         Returns:
-            {ヘッダ名: 内容, ... ,"Body": [{本文パートヘッダ名: 内容, ... , "data": 本文}, ...]}
+            unique_id, message_number
         """
-        msg = b'\r\n'.join(retr_result[1])
-        return parse_email(msg)
+        msg_no, uid = uid_bytes.split()
+        return uid.decode(), int(msg_no)
+
+
+def _parse_message(retr_result: tuple, logger: logging.Logger = None, lazy: bool = False) -> dict:
+    """
+    POP3.retr または POP3Client._longcmd_pipelined の戻り値をパースした結果を戻す
+    ProcessPoolExecutor から呼び出せるようモジュールレベルに定義する
+    ---
+    Parameters:
+        retr_result: POP3.retr または POP3Client._longcmd_pipelined の戻り値
+        logger: ヘッダのデコードを省略したときに警告を記録するLogger
+        lazy: parse_email と同様
+    ---
+    Returns:
+        {ヘッダ名: 内容, ... ,"Body": [{本文パートヘッダ名: 内容, ... , "data": 本文}, ...]}
+    """
+    msg = retr_result[1]
+    if isinstance(msg, list):
+        msg = b'\r\n'.join(msg)
+    return parse_email(msg, logger, lazy)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_default_logger(host: str, user: str) -> logging.Logger:
+    logger = logging.getLogger(f'POP3/{host}/{user}')
+    logger.setLevel('INFO')
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        formatter = logging.Formatter(fmt="%(levelname)s\t%(asctime)s\t%(name)s\t%(message)s",
+                                      datefmt="%Y-%m-%d %H:%M:%S")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+def _pool_get(key: tuple, logger: logging.Logger):
+    """
+    プールから認証済みの接続を取り出す
+    POOL_IDLE_TIMEOUT または POOL_MAX_AGE を過ぎた接続はサインアウトして捨てる
+    プールにある間にサーバから切断された接続は、NOOP で確認して捨てる
+    ---
+    Parameters:
+        key: プールのキー
+        logger: 取り出した接続のログを記録するLogger。確認の NOOP からこの Logger に記録する
+    ---
+    Returns:
+        POP3_plus_logging または POP3_SSL_plus_logging のインスタンス。プールが空のときは None
+    """
+    with _POOL_LOCK:
+        pool = _POOL.get(key)
+    if pool is None:
+        return None
+    while True:
+        try:
+            pop3 = pool.get_nowait()
+        except queue.Empty:
+            return None
+        pop3.logger = logger
+        now = time.monotonic()
+        if now - pop3.last_used >= POOL_IDLE_TIMEOUT or now - pop3.created >= POOL_MAX_AGE:
+            _pool_close(pop3)
+            continue
+        try:
+            pop3.noop()
+        except (poplib.error_proto, OSError):
+            pop3.close()
+            continue
+        return pop3
 
-    def _get_default_logger(self):
-        logger = logging.getLogger(f'POP3/{self.host}/{self.user}')
-        logger.setLevel('INFO')
-        if not logger.handlers:
-            handler = logging.StreamHandler()
-            formatter = logging.Formatter(fmt="%(levelname)s\t%(asctime)s\t%(name)s\t%(message)s",
-                                          datefmt="%Y-%m-%d %H:%M:%S")
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
-        return logger
+
+def _pool_put(key: tuple, pop3):
+    """
+    NOOP で接続が生きていることを確認し、プールに戻す
+    応答がないときは接続を閉じて捨てる
+    削除フラグが立っているとき、または POOL_MAX_AGE を過ぎたときは、プールに戻さずにサインアウトする
+    ---
+    Parameters:
+        key: プールのキー
+        pop3: POP3_plus_logging または POP3_SSL_plus_logging のインスタンス
+    """
+    if pop3.deleted or time.monotonic() - pop3.created >= POOL_MAX_AGE:
+        _pool_close(pop3)
+        return
+    try:
+        pop3.noop()
+    except (poplib.error_proto, OSError):
+        pop3.close()
+        return
+    pop3.last_used = time.monotonic()
+    with _POOL_LOCK:
+        pool = _POOL.setdefault(key, queue.LifoQueue())
+    pool.put(pop3)
+
+
+def _pool_close(pop3):
+    """
+    サインアウトして接続を閉じる。サーバから応答がないときはそのまま閉じる
+    """
+    try:
+        pop3.quit()
+    except (poplib.error_proto, OSError):
+        pop3.close()
+
+
+def _get_error_message(e: poplib.error_proto) -> str:
+    """
+    poplib.error_proto のメッセージを戻す
+    サーバの応答は bytes、poplib 自身が送出するもの ('-ERR EOF' など) は str で渡される
+    """
+    resp = e.args[0]
+    return resp.decode() if isinstance(resp, bytes) else resp
+
+
+# add_POP3_res_logging がログ出力を追加するメソッド名と、その戻り値からログに記録するメッセージを作る関数
+_RESPONSE_FORMATTERS = {
+    **dict.fromkeys(('getwelcome', 'user', 'pass_', 'dele', 'noop', 'rset', 'quit', 'rpop', 'apop',
+                     'utf8', 'stls'),
+                    lambda result: result.decode()),
+    **dict.fromkeys(('retr', 'top'),
+                    lambda result: result[0].decode()),
+    'capa': lambda result: str(result),
+    **dict.fromkeys(('list', 'uidl'),
+                    lambda result: result[0].decode() if isinstance(result, tuple) else result.decode()),
+    'stat': lambda result: f'massage_count={result[0]}, mailbox_size={result[1]}',
+}
 
 
 def add_POP3_res_logging(func) -> Callable:
     """
     POP3, POP3_SSLクラスのサーバ問い合わせメソッドに、
     サーバからのレスポンスをself.loggerに渡す処理を追加するデコレータ
+    func の名前が _RESPONSE_FORMATTERS にないときは func をそのまま戻す
     """
     if not callable(func):
         return func
-
-    if func.__name__ in ('getwelcome', 'user', 'pass_', 'dele',
-                         'noop', 'rset', 'quit', 'rpop', 'apop', 'utf8', 'stls'):
-        def get_message(result):
-            return result.decode()
-    elif func.__name__ in ('retr', 'top'):
-        def get_message(result):
-            return result[0].decode()
-    elif func.__name__ in ('capa',):
-        def get_message(result):
-            return str(result)
-    elif func.__name__ in ('list', 'uidl'):
-        def get_message(result):
-            return result[0].decode() if isinstance(result, tuple) else result.decode()
-    elif func.__name__ in ('stat',):
-        def get_message(result):
-            return f'massage_count={result[0]}, mailbox_size={result[1]}'
-    else:
+    get_message = _RESPONSE_FORMATTERS.get(func.__name__)
+    if get_message is None:
         return func
 
     @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
         try:
             result = func(self, *args, **kwargs)
-            msg = get_message(result)
-            if msg:
-                self.logger.info(f"{wrapper.__name__} -> {msg}")
-            return result
         except poplib.error_proto as e:
-            self.logger.error(e.args[0].decode())
+            self.logger.error(_get_error_message(e))
             raise
         except Exception:
             self.logger.exception('UnexpectedError')
             raise
+        if self.logger.isEnabledFor(logging.INFO):
+            msg = get_message(result)
+            if msg:
+                self.logger.info("%s -> %s", wrapper.__name__, msg)
+        return result
 
     return wrapper
 
 
-class POP3_plus_logging_meta(type):
-    def __new__(cls, classname, bases, attributes):
-        instance = super().__new__(cls, classname, bases, attributes)
-        for attr in dir(instance):
-            value = getattr(instance, attr)
-            if callable(value):
-                setattr(instance, attr, add_POP3_res_logging(value))
-        return instance
-
-
-class POP3_plus_logging(poplib.POP3, metaclass=POP3_plus_logging_meta):
+class _POP3_plus_logging_mixin:
+    """
+    POP3_plus_logging, POP3_SSL_plus_logging 共通の、ログ出力先と接続プール用の状態を持つ
+    ---
+    Parameters:
+        logger: pop3通信を行ったときのサーバからのメッセージをログとして記録するLogger
+    """
     def __init__(self, *args, logger, **kwargs):
         self.logger = logger
+        self.pipelining = None
+        self.retr_count = 0
+        self.deleted = False
+        self.created = self.last_used = time.monotonic()
         super().__init__(*args, **kwargs)
 
+    def dele(self, which):
+        result = super().dele(which)
+        self.deleted = True
+        return result
 
-class POP3_SSL_plus_logging(poplib.POP3_SSL, metaclass=POP3_plus_logging_meta):
-    def __init__(self, *args, logger, **kwargs):
-        self.logger = logger
-        super().__init__(*args, **kwargs)
+    def rset(self):
+        result = super().rset()
+        self.deleted = False
+        return result
+
+
+class POP3_plus_logging(_POP3_plus_logging_mixin, poplib.POP3):
+    pass
+
+
+class POP3_SSL_plus_logging(_POP3_plus_logging_mixin, poplib.POP3_SSL):
+    pass
+
+
+for _cls in (POP3_plus_logging, POP3_SSL_plus_logging):
+    for _attr in _RESPONSE_FORMATTERS:
+        setattr(_cls, _attr, add_POP3_res_logging(getattr(_cls, _attr)))
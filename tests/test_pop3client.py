@@ -0,0 +1,384 @@
+import email
+import json
+import logging
+import pickle
+import socket
+import socketserver
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import poplib
+
+import EmailClient
+
+MESSAGES = [
+    b"From: a@example.com\r\nSubject: first\r\n\r\nline1\r\n.dotted\r\n",
+    b"From: b@example.com\r\nSubject: second\r\n\r\nline2\r\n",
+    b"From: c@example.com\r\nSubject: third\r\n\r\n..double\r\n",
+]
+
+
+class _FakePOP3Handler(socketserver.StreamRequestHandler):
+    def _send(self, line):
+        self.wfile.write(line + b"\r\n")
+
+    def _send_message(self, msg):
+        self._send(b"+OK")
+        for line in msg.split(b"\r\n")[:-1]:
+            # RFC 1939 のバイトスタッフィング
+            self._send(b"." + line if line.startswith(b".") else line)
+        self._send(b".")
+
+    def handle(self):
+        server = self.server
+        server.connections.append(self.connection)
+        self._send(b"+OK ready <1.2@localhost>")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b" ")
+            server.commands.append(b" ".join(command))
+            name = command[0].upper()
+            if name in (b"USER", b"PASS", b"APOP", b"NOOP", b"RSET", b"DELE"):
+                self._send(b"+OK")
+            elif name == b"CAPA":
+                self._send(b"+OK")
+                if server.pipelining:
+                    self._send(b"PIPELINING")
+                self._send(b".")
+            elif name == b"UIDL":
+                self._send(b"+OK")
+                for i in range(1, len(MESSAGES) + 1):
+                    self._send(server.uidl_format % (i, i))
+                self._send(b".")
+            elif name in (b"RETR", b"TOP"):
+                no = int(command[1])
+                if not 1 <= no <= len(MESSAGES):
+                    self._send(b"-ERR no such message")
+                    continue
+                msg = MESSAGES[no - 1]
+                if name == b"TOP":
+                    msg = msg.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+                self._send_message(msg)
+            elif name == b"QUIT":
+                self._send(b"-ERR not committed" if server.quit_error else b"+OK bye")
+                return
+            else:
+                self._send(b"-ERR unknown command")
+
+
+class _FakePOP3Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, pipelining=True):
+        super().__init__(("127.0.0.1", 0), _FakePOP3Handler)
+        self.pipelining = pipelining
+        self.quit_error = False
+        self.uidl_format = b"%d uid%d"
+        self.commands = []
+        self.connections = []
+
+    def drop_connections(self):
+        for connection in self.connections:
+            connection.shutdown(socket.SHUT_RDWR)
+
+
+class _FailingExecutor:
+    def submit(self, *args, **kwargs):
+        raise RuntimeError("submit failed")
+
+
+class _FakePOP3TestCase(unittest.TestCase):
+    pipelining = True
+
+    def setUp(self):
+        self.server = _FakePOP3Server(pipelining=self.pipelining)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = EmailClient.POP3Client("user", "pass", "127.0.0.1", port=self.server.server_address[1],
+                                             use_ssl=False)
+        self.client.logger.setLevel("CRITICAL")
+        self.client.connect()
+        self.addCleanup(self.client.quit, reuse=False)
+
+
+class POP3ClientPipeliningTest(_FakePOP3TestCase):
+    def test_framing(self):
+        msgs = self.client.get_messages({"uid1": 1, "uid2": 2, "uid3": 3})
+        self.assertEqual([msg["Subject"] for msg in msgs.values()], ["first", "second", "third"])
+        self.assertEqual(msgs["uid1"]["Body"][0]["data"], "line1\r\n.dotted")
+        self.assertEqual(msgs["uid3"]["Body"][0]["data"], "..double")
+
+    def test_explicit_pipeline_depth_skips_capa(self):
+        self.client.pipeline_depth = 1
+        msgs = self.client.get_messages({"uid1": 1, "uid2": 2})
+        self.assertEqual([msg["Subject"] for msg in msgs.values()], ["first", "second"])
+        self.assertNotIn(b"CAPA", self.server.commands)
+
+    def test_invalid_pipeline_depth(self):
+        for depth in (0, -1):
+            with self.assertRaises(ValueError):
+                EmailClient.POP3Client("user", "pass", "127.0.0.1", pipeline_depth=depth)
+
+    def test_error_response_keeps_connection_in_sync(self):
+        with self.assertRaises(poplib.error_proto):
+            self.client.get_messages({"uid1": 1, "bad": 99, "uid2": 2})
+        self.assertEqual(self.client.get_all_unique_id(), {"uid1": 1, "uid2": 2, "uid3": 3})
+
+    def test_consumer_error_drains_responses(self):
+        self.client.parse_executor = _FailingExecutor()
+        try:
+            self.client.get_messages({"uid1": 1, "uid2": 2, "uid3": 3})
+        except RuntimeError:
+            # 例外のトレースバックが生きている間に次のコマンドを送っても同期が取れていること
+            self.assertEqual(self.client.get_all_unique_id(), {"uid1": 1, "uid2": 2, "uid3": 3})
+        else:
+            self.fail("RuntimeError not raised")
+
+
+class POP3ClientNoPipeliningTest(POP3ClientPipeliningTest):
+    pipelining = False
+
+
+class POP3ClientJoinedResponseTest(_FakePOP3TestCase):
+    def test_joined_response_matches_poplib(self):
+        for msg_no in range(1, len(MESSAGES) + 1):
+            self.client.pop3._putcmd(f"RETR {msg_no}")
+            joined = self.client._getlongresp_joined()
+            resp, lines, octets = self.client.pop3.retr(msg_no)
+            self.assertEqual(joined[0], resp)
+            self.assertEqual(bytes(joined[1]), b"\r\n".join(lines))
+            self.assertEqual(joined[2], octets)
+
+
+class POP3ClientHeadersOnlyTest(_FakePOP3TestCase):
+    def test_headers_only(self):
+        headers = self.client.get_headers_only({"uid2": 2})
+        self.assertEqual(headers["uid2"], {"From": "b@example.com", "Subject": "second"})
+        self.assertIn(b"TOP 2 0", self.server.commands)
+        self.assertFalse(any(command.startswith(b"RETR") for command in self.server.commands))
+
+
+class POP3ClientParseExecutorTest(_FakePOP3TestCase):
+    def test_parse_executor(self):
+        uid_dict = {"uid1": 1, "uid2": 2, "uid3": 3}
+        expected = self.client.get_messages(uid_dict)
+        with ThreadPoolExecutor(2) as executor:
+            self.client.parse_executor = executor
+            self.assertEqual(self.client.get_messages(uid_dict), expected)
+        self.assertEqual(self.client.pop3.retr_count, 2 * len(uid_dict))
+
+
+class POP3ClientQuitTest(_FakePOP3TestCase):
+    def test_quit_twice(self):
+        self.client.quit()
+        self.client.quit()
+        self.assertIsNone(self.client.pop3)
+        self.assertEqual(self.server.commands.count(b"QUIT"), 1)
+
+    def test_quit_before_connect(self):
+        client = EmailClient.POP3Client("user", "pass", "127.0.0.1")
+        client.quit()
+        self.assertIsNone(client.pop3)
+
+    def test_del_half_built_instance(self):
+        EmailClient.POP3Client.__new__(EmailClient.POP3Client).__del__()
+        with self.assertRaises(ValueError):
+            EmailClient.POP3Client("user", "pass", "127.0.0.1", pipeline_depth=0)
+
+    def test_quit_error_is_raised(self):
+        pop3 = self.client.pop3
+        self.server.quit_error = True
+        with self.assertRaises(poplib.error_proto):
+            self.client.quit()
+        self.assertIsNone(self.client.pop3)
+        self.assertIsNone(pop3.sock)
+
+    def test_exit_raises_quit_error(self):
+        self.client.quit()
+        self.server.quit_error = True
+        with self.assertRaises(poplib.error_proto):
+            with self.client:
+                pass
+        self.assertIsNone(self.client.pop3)
+
+    def test_del_suppresses_quit_error(self):
+        pop3 = self.client.pop3
+        self.server.quit_error = True
+        self.client.__del__()
+        self.assertIsNone(self.client.pop3)
+        self.assertIsNone(pop3.sock)
+
+
+class POP3ClientUniqueIdTest(_FakePOP3TestCase):
+    def test_extra_spaces_in_uidl(self):
+        self.server.uidl_format = b"%d  uid%d "
+        self.assertEqual(self.client.get_all_unique_id(), {"uid1": 1, "uid2": 2, "uid3": 3})
+        self.client.old_uid = {"uid2"}
+        self.assertEqual(self.client.get_new_unique_id(), {"uid1": 1, "uid3": 3})
+
+
+class POP3ClientPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _FakePOP3Server()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self._clear_pool)
+
+    def _clear_pool(self):
+        with EmailClient._POOL_LOCK:
+            pools = list(EmailClient._POOL.values())
+            EmailClient._POOL.clear()
+        for pool in pools:
+            while not pool.empty():
+                pool.get_nowait().close()
+
+    def _client(self, **kwargs):
+        client = EmailClient.POP3Client("user", "pass", "127.0.0.1", port=self.server.server_address[1],
+                                        use_ssl=False, use_pool=True, **kwargs)
+        client.logger.setLevel("CRITICAL")
+        return client
+
+    def test_connection_is_reused(self):
+        with self._client() as client:
+            first = client.pop3
+        with self._client() as client:
+            self.assertIs(client.pop3, first)
+        client.quit(reuse=False)
+
+    def test_checkout_is_logged_to_new_logger(self):
+        with self._client(logger=logging.getLogger("test.pool.first")):
+            pass
+        client = self._client(logger=logging.getLogger("test.pool.second"))
+        with self.assertLogs("test.pool.second", "INFO") as logs:
+            client.connect()
+        self.assertIn("noop -> +OK", logs.output[0])
+        client.quit(reuse=False)
+
+    def test_dropped_connection_is_replaced(self):
+        with self._client() as client:
+            first = client.pop3
+        self.server.drop_connections()
+        with self._client() as client:
+            self.assertIsNot(client.pop3, first)
+            self.assertEqual(client.get_all_unique_id(), {"uid1": 1, "uid2": 2, "uid3": 3})
+
+    def test_connection_with_pending_delete_is_not_pooled(self):
+        with self._client() as client:
+            first = client.pop3
+            client.pop3.dele(1)
+        self.assertIn(b"QUIT", self.server.commands)
+        with self._client() as client:
+            self.assertIsNot(client.pop3, first)
+
+    def test_old_connection_is_not_reused(self):
+        with self._client() as client:
+            first = client.pop3
+        first.created -= EmailClient.POOL_MAX_AGE
+        with self._client() as client:
+            self.assertIsNot(client.pop3, first)
+        self.assertIn(b"QUIT", self.server.commands)
+
+    def test_option_and_auth_method_are_part_of_key(self):
+        with self._client() as client:
+            first = client.pop3
+        with self._client(option={"timeout": 5}) as client:
+            self.assertIsNot(client.pop3, first)
+        with self._client(auth_method="apop") as client:
+            self.assertIsNot(client.pop3, first)
+
+
+class AddPOP3ResLoggingTest(unittest.TestCase):
+    def test_unknown_method_is_returned_unchanged(self):
+        def list_messages(self):
+            pass
+        self.assertIs(EmailClient.add_POP3_res_logging(list_messages), list_messages)
+        self.assertIs(EmailClient.add_POP3_res_logging(None), None)
+
+
+class ParseEmailTest(unittest.TestCase):
+    UNDECODABLE = (b"From: a@example.com\r\nSubject: =?utf-8?b?44GC?=\r\nTo: =?x-unknown?q?abc?=\r\n"
+                   b"\r\nbody\r\n")
+
+    def test_result_is_dict(self):
+        msg = EmailClient.parse_email(MESSAGES[0])
+        self.assertIsInstance(msg, dict)
+        self.assertEqual(json.loads(json.dumps(msg))["Subject"], "first")
+        with self.assertRaises(LookupError):
+            EmailClient.parse_email(self.UNDECODABLE)
+
+    def test_lazy_headers_are_decoded_on_access(self):
+        msg = EmailClient.parse_email(self.UNDECODABLE, lazy=True)
+        self.assertIn("To", msg)
+        self.assertIsNone(msg.get("Cc"))
+        self.assertEqual(msg["Subject"], "\u3042")
+        self.assertEqual(msg.get("From"), "a@example.com")
+        copied = msg.copy()
+        copied["To"] = "b@example.com"
+        self.assertEqual(copied["To"], "b@example.com")
+        with self.assertRaises(LookupError):
+            msg["To"]
+
+    def test_lazy_headers_are_decoded_before_pickling(self):
+        msg = EmailClient.parse_headers(MESSAGES[1], lazy=True)
+        self.assertEqual(dict(pickle.loads(pickle.dumps(msg))), {"From": "b@example.com", "Subject": "second"})
+
+    def test_first_header_occurrence_is_used(self):
+        msg = EmailClient.parse_email(b"Received: first\r\nreceived: second\r\nSUBJECT: subject\r\n"
+                                      b"from: a@example.com\r\n\r\nbody\r\n")
+        self.assertEqual(msg["Received"], "first")
+        self.assertEqual(msg["Subject"], "subject")
+        self.assertEqual(list(msg), ["From", "Subject", "Received", "Body"])
+
+    def test_single_part_matches_walk(self):
+        single = (b"From: a@example.com\r\nSubject: =?utf-8?b?44GC?=\r\n"
+                  b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n"
+                  b"44GC44GE\r\n")
+        multi = (b"From: a@example.com\r\nContent-Type: multipart/mixed; boundary=b\r\n\r\n"
+                 b"--b\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n"
+                 b"44GC44GE\r\n--b\r\nContent-Type: application/octet-stream\r\n\r\nbin\r\n--b--\r\n")
+        for data in (single, multi):
+            expected = [body_data for part in email.message_from_bytes(data).walk()
+                        if (body_data := EmailClient._get_body_data(part))]
+            self.assertEqual(EmailClient.parse_email(data)["Body"], expected)
+        body = EmailClient.parse_email(single)["Body"]
+        self.assertEqual(body[0]["Subject"], "=?utf-8?b?44GC?=")
+        self.assertEqual(body[0]["data"], "\u3042\u3044")
+        self.assertEqual(EmailClient.parse_email(multi)["Body"][0]["data"], "\u3042\u3044")
+
+    def _parse_subject(self, subject):
+        return EmailClient.parse_headers(b"Subject: " + subject.encode() + b"\r\n\r\n")["Subject"]
+
+    def test_header_at_limit_is_decoded(self):
+        filler = "a" * (EmailClient.MAX_HEADER_LENGTH - len("=?utf-8?b?44GC?= "))
+        self.assertEqual(self._parse_subject("=?utf-8?b?44GC?= " + filler), "\u3042 " + filler)
+        filler = ";" * EmailClient.MAX_HEADER_SEPARATORS
+        self.assertEqual(self._parse_subject("=?utf-8?b?44GC?= " + filler), "\u3042 " + filler)
+
+    def test_long_header_is_not_decoded(self):
+        encoded = "=?utf-8?b?44GC?="
+        subject = encoded + "a" * (EmailClient.MAX_HEADER_LENGTH - len(encoded) + 1)
+        with self.assertLogs("EmailClient", "WARNING") as logs:
+            self.assertEqual(self._parse_subject(subject), subject)
+        self.assertIn("Subject header not decoded", logs.output[0])
+
+    def test_header_with_many_separators_is_not_decoded(self):
+        subject = "=?utf-8?b?44GC?=" + ";" * (EmailClient.MAX_HEADER_SEPARATORS + 1)
+        with self.assertLogs("EmailClient", "WARNING") as logs:
+            self.assertEqual(self._parse_subject(subject), subject)
+        self.assertIn("Subject header not decoded", logs.output[0])
+
+    def test_undecodable_charset_falls_back_to_utf8(self):
+        for charset in ("idna", "punycode", "x-unknown"):
+            msg = EmailClient.parse_email(b"Content-Type: text/plain; charset=" + charset.encode()
+                                          + b"\r\n\r\n\xe3\x81\x82\xff")
+            self.assertEqual(msg["Body"][0]["data"], "\u3042\ufffd")
+            self.assertEqual(msg["Body"][0]["charset"], "utf-8")
+
+
+if __name__ == "__main__":
+    unittest.main()